@@ -1,6 +1,8 @@
+import functools
 import json
 import logging
 import os
+from contextlib import aclosing
 
 import httpx
 from fastapi import Form
@@ -8,19 +10,29 @@ from fastapi.responses import JSONResponse
 from fastapi_poe.client import get_bot_response, get_final_response, QueryRequest
 from fastapi_poe.types import ProtocolMessage
 
+from util import similarity_cache, tracing
+
 timeout = 500
 
 logging.basicConfig(level=logging.DEBUG)
 
 client_dict = {}
 
+# 每个 worker 共用一个带连接池的客户端，首次使用时创建，关闭时由 close_clients 释放
+_client = None
+
 
-async def get_responses(api_key, prompt=[], bot=""):
+async def get_responses(api_key, prompt=[], bot="", cache_namespace=None):
     bot_name = bot
     # "system", "user", "bot"
-    messages = openai_message_to_poe_message(prompt)
+    with tracing.span("convert_messages", count=len(prompt)):
+        messages = openai_message_to_poe_message(prompt)
     print("=================", messages, "=================")
 
+    cached, cache_key = similarity_cache.lookup(cache_namespace or api_key, bot_name, messages)
+    if cached is not None:
+        return cached
+
     additional_params = {"temperature": 0.7, "skip_system_prompt": False, "logit_bias": {}, "stop_sequences": []}
     query = QueryRequest(
         query=messages,
@@ -32,8 +44,11 @@ async def get_responses(api_key, prompt=[], bot=""):
         **additional_params
     )
 
-    session = create_client()
-    return await get_final_response(query, bot_name=bot_name, api_key=api_key, session=session)
+    session = get_client()
+    with tracing.span("upstream.final_response", bot=bot_name):
+        result = await get_final_response(query, bot_name=bot_name, api_key=api_key, session=session)
+    similarity_cache.store(cache_key, result)
+    return result
 
 
 def is_thinking_token(text):
@@ -50,13 +65,27 @@ def is_thinking_token(text):
 
 async def stream_get_responses(api_key, prompt, bot):
     bot_name = bot
-    messages = openai_message_to_poe_message(prompt)
-
-    session = create_client()
-    async for partial in get_bot_response(messages=messages, bot_name=bot_name, api_key=api_key,
-                                          skip_system_prompt=False, session=session):
-        if not is_thinking_token(partial.text):
-            yield partial.text
+    with tracing.span("convert_messages", count=len(prompt)):
+        messages = openai_message_to_poe_message(prompt)
+
+    session = get_client()
+
+    # 首个分片之前的耗时即 TTFT，之后为流式阶段
+    first_partial = tracing.start_span("upstream.first_partial", bot=bot_name)
+    streaming = None
+    partials = 0
+    # 提前结束时（取消、客户端断开）立即关闭上游流，连接归还连接池
+    async with aclosing(get_bot_response(messages=messages, bot_name=bot_name, api_key=api_key,
+                                         skip_system_prompt=False, session=session)) as partial_stream:
+        async for partial in partial_stream:
+            if streaming is None:
+                tracing.end_span(first_partial)
+                streaming = tracing.start_span("upstream.stream", bot=bot_name)
+            partials += 1
+            if not is_thinking_token(partial.text):
+                yield partial.text
+    tracing.end_span(first_partial)
+    tracing.end_span(streaming, partials=partials)
 
 
 async def get_image(api_key, prompt, bot="dall-e-3"):
@@ -74,16 +103,17 @@ async def get_image(api_key, prompt, bot="dall-e-3"):
     bot_name = get_bot(bot)
     message = ProtocolMessage(role="user", content=prompt)
     
-    session = create_client()
+    session = get_client()
     logging.info(f"发送图像生成请求到 {bot_name}，提示词: {prompt}")
     
     result = ""
-    async for partial in get_bot_response(messages=[message], bot_name=bot_name, api_key=api_key,
-                                          skip_system_prompt=False, session=session):
-        # 保存最终结果
-        if partial.text and (partial.text.startswith("![") or "http" in partial.text):
-            result = partial.text
-            logging.info(f"收到图像结果: {result}")
+    with tracing.span("upstream.image", bot=bot_name):
+        async for partial in get_bot_response(messages=[message], bot_name=bot_name, api_key=api_key,
+                                              skip_system_prompt=False, session=session):
+            # 保存最终结果
+            if partial.text and (partial.text.startswith("![") or "http" in partial.text):
+                result = partial.text
+                logging.info(f"收到图像结果: {result}")
     
     return result
 
@@ -100,39 +130,53 @@ def add_token(token: str):
         return "exist"
 
 
+@functools.lru_cache(maxsize=1)
+def get_model_mapping():
+    return json.loads(os.environ.get("MODEL_MAPPING", "{}"))
+
+
 def get_bot(model):
-    model_mapping = json.loads(os.environ.get("MODEL_MAPPING", "{}"))
-    return model_mapping.get(model, "Unknown Model")
+    return get_model_mapping().get(model, "Unknown Model")
 
 
 def openai_message_to_poe_message(messages=[]):
     new_messages = []
     for message in messages:
-        role = message["role"]
+        role = message.role
         if role == 'developer':
             continue
         if role == "assistant":
             role = "bot"
 
         # Handle content properly based on its type
-        content = message["content"]
+        content = message.content
         if isinstance(content, list):
             # Process the list of content parts
             processed_content = ""
             for item in content:
-                if isinstance(item, dict):
-                    if item.get("type") == "text":
-                        processed_content += item.get("text", "")
-                    # Handle other types as needed
-                else:
-                    processed_content += str(item)
+                if isinstance(item, str):
+                    processed_content += item
+                elif item.type == "text":
+                    processed_content += item.text or ""
+                # Handle other types as needed
             content = processed_content
-        elif not isinstance(content, str):
-            content = str(content)
+        elif content is None:
+            content = ""
 
         new_messages.append(ProtocolMessage(role=role, content=content))
     return new_messages
 
+def get_connection_limits():
+    """
+    上游连接池大小：UPSTREAM_MAX_CONNECTIONS 优先，其次与 SCHEDULER_CAPACITY 一致，都未配置时不限制
+    """
+    max_connections = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", "0")) or \
+        int(os.environ.get("SCHEDULER_CAPACITY", "0"))
+    if max_connections <= 0:
+        return httpx.Limits(max_connections=None, max_keepalive_connections=20)
+    return httpx.Limits(max_connections=max_connections, max_keepalive_connections=min(20, max_connections))
+
+
 def create_client():
     proxy_config = {
         "proxy_type": os.environ.get("PROXY_TYPE"),
@@ -143,10 +187,31 @@ def create_client():
     }
 
     proxy = create_proxy(proxy_config)
-    client = httpx.AsyncClient(timeout=600, proxies=proxy)
+    client = httpx.AsyncClient(timeout=600, proxies=proxy, limits=get_connection_limits(), event_hooks={"request": [add_trace_context]})
     return client
 
 
+def get_client():
+    global _client
+    if _client is None or _client.is_closed:
+        _client = create_client()
+    return _client
+
+
+async def close_clients():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def add_trace_context(request):
+    request.headers.update(tracing.outgoing_headers())
+    tracer = tracing.connection_tracer()
+    if tracer is not None:
+        request.extensions["trace"] = tracer
+
+
 def create_proxy(proxy_config):
     proxy_type = proxy_config["proxy_type"]
     proxy_url = create_proxy_url(proxy_config)
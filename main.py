@@ -1,11 +1,18 @@
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
 from starlette.middleware.base import BaseHTTPMiddleware
 
+from api import poe_api
 from route.route_chat import router as chat_router
 from route.route_image import router as image_router
 from route.route_ollama import router as ollama_router
+from route.route_ws import router as ws_router
+from util import tracing, tenants
+from util.request_models import RequestError
+from util.scheduler import SchedulerError
+from util.tenants import TenantError
 
 class CustomCORSMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
@@ -28,23 +35,63 @@ class CustomCORSMiddleware(BaseHTTPMiddleware):
         response.headers['Access-Control-Allow-Credentials'] = 'true'
         response.headers['Access-Control-Allow-Methods'] = '*'
         response.headers['Access-Control-Allow-Headers'] = '*'
+        response.headers['Access-Control-Expose-Headers'] = 'X-Request-ID, traceparent'
 
         return response
 
+
+class TracingMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        trace = tracing.start_trace(request.headers, f"{request.method} {request.url.path}")
+        try:
+            response = await call_next(request)
+        except Exception as e:
+            tracing.finish_trace(trace, error=repr(e))
+            raise
+
+        # 回显请求 ID，便于把客户端反馈和追踪记录对应起来
+        response.headers['X-Request-ID'] = trace.request_id
+        response.headers['traceparent'] = trace.traceparent()
+        response.body_iterator = tracing.trace_body(trace, response.body_iterator)
+        return response
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup code here
     print("Starting up...")
+    await tenants.init()
     yield
-    # Shutdown code he
+    # Shutdown code here
+    # uvicorn 在所有连接结束（或 graceful timeout 到期）后才执行这里，只需关闭上游连接池
     print("Shutting down...")
+    await poe_api.close_clients()
 
 
 app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(CustomCORSMiddleware)
+app.add_middleware(TracingMiddleware)
+
+
+@app.exception_handler(TenantError)
+async def tenant_error_handler(request: Request, exc: TenantError):
+    return JSONResponse(content={"error": exc.message}, status_code=exc.status_code)
+
+
+@app.exception_handler(RequestError)
+async def request_error_handler(request: Request, exc: RequestError):
+    return JSONResponse(content={"error": exc.message}, status_code=exc.status_code)
+
+
+@app.exception_handler(SchedulerError)
+async def scheduler_error_handler(request: Request, exc: SchedulerError):
+    return JSONResponse(content={"error": exc.message}, status_code=exc.status_code, headers={"Retry-After": "1"})
 
 
 app.include_router(chat_router)
 app.include_router(image_router)
-app.include_router(ollama_router)
\ No newline at end of file
+app.include_router(ollama_router)
+app.include_router(ws_router)
+
+# 在 gunicorn --preload 时于 master 中预先加载，fork 出的 worker 直接复用
+poe_api.get_model_mapping()
@@ -1,6 +1,5 @@
 import json
 import logging
-import os
 from datetime import datetime
 
 from dotenv import load_dotenv
@@ -9,7 +8,7 @@ from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 
 from api import poe_api
-from util import utils
+from util import utils, similarity_cache, tenants, tracing, request_models, scheduler
 
 app = FastAPI()
 logger = logging.getLogger(__name__)
@@ -41,48 +40,38 @@ async def get_models():
     ]
     return {"data": models}
 
+@router.get("/v1/cache/stats")
+async def get_cache_stats():
+    return similarity_cache.get_stats()
+
+@router.get("/v1/scheduler/stats")
+async def get_scheduler_stats():
+    return scheduler.get_stats()
+
 @router.post("/v1/chat/completions")
 async def chat_proxy(request: Request):
-    body = await request.json()
-    model, messages, stream = parse_request_body(body)
-    if model is None:
-        return JSONResponse(content={"error": "Invalid request body"}, status_code=400)
+    with tracing.span("request.parse"):
+        body = await request_models.read_body(request, request_models.ChatCompletionRequest)
+        model, messages, stream = parse_request_body(body)
 
-    token = await get_token_from_request(request)
+    token, tenant = await tenants.authorize(request, model)
+    lane = scheduler.get_lane(request, tenant)
 
     if stream:
-        return StreamingResponse(process_openai_response_event_stream(model, messages, token),
-                                 media_type="text/event-stream")
+        stream_slot = await tenants.acquire_stream(tenant)
+        lease = await scheduler.acquire(lane, stream_slot)
+        return StreamingResponse(
+            tenants.track_stream(
+                stream_slot, scheduler.track_stream(lease, process_openai_response_event_stream(model, messages, token))),
+            media_type="text/event-stream")
     else:
-        return await default_response(model, messages, token)
-
-
-def parse_request_body(body):
-    try:
-        model = body.get('model', 'gpt-3.5-turbo')
-        messages = body.get('messages', [])
-        stream = body.get('stream', False)
-
-        return model, messages, stream
-    except json.JSONDecodeError as e:
-        logger.debug(f"请求体解析错误: {e}")
-        return None, None, None
-
-
-async def get_token_from_request(request_data):
-    logger.info("请求头: %s", request_data.headers)
-    logger.info("开始获取token")
-    token = request_data.headers.get('Authorization', '').replace('Bearer ', '')
-
-    # 自定义token
-    custom_token = os.environ.get('CUSTOM_TOKEN')
-    # 内置token
-    system_token = os.environ.get('SYSTEM_TOKEN')
+        async with scheduler.slot(lane):
+            return await default_response(model, messages, token, tenants.cache_namespace(request, tenant))
 
-    if token == custom_token:
-        return system_token
 
-    return token
+def parse_request_body(body: request_models.ChatCompletionRequest):
+    request_models.check_message_count(body.messages)
+    return body.model, body.messages, body.stream
 
 
 async def process_openai_response_event_stream(model, messages, token):
@@ -114,10 +103,11 @@ def web_response_to_api_response_stream(result, model, stop=None):
     return data
 
 
-async def default_response(model, messages, token):
-    result = await poe_api.get_responses(token, messages, model)
+async def default_response(model, messages, token, cache_namespace=None):
+    result = await poe_api.get_responses(token, messages, model, cache_namespace)
 
-    data = web_response_to_api_response(model, result)
+    with tracing.span("response.serialize"):
+        data = web_response_to_api_response(model, result)
 
     return JSONResponse(content=data)
 
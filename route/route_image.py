@@ -1,6 +1,5 @@
 import json
 import logging
-import os
 from datetime import datetime
 
 from dotenv import load_dotenv
@@ -8,7 +7,7 @@ from fastapi import APIRouter, Request
 from fastapi.responses import JSONResponse
 
 from api import poe_api
-from util import utils
+from util import utils, tenants, tracing, request_models, scheduler
 
 logger = logging.getLogger(__name__)
 
@@ -21,34 +20,26 @@ async def image_generation(request: Request):
     """
     兼容OpenAI的图像生成API
     """
-    body = await request.json()
-    prompt, n, size, model, response_format = parse_request_body(body)
+    with tracing.span("request.parse"):
+        body = await request_models.read_body(request, request_models.ImageGenerationRequest)
+        prompt, n, size, model, response_format = parse_request_body(body)
     
-    token = await get_token_from_request(request)
+    token, tenant = await tenants.authorize(request, model)
     
     # 处理提示词和尺寸
     formatted_prompt = format_prompt_with_size(prompt, size)
     
-    result = await generate_image(token, formatted_prompt, model)
+    async with scheduler.slot(scheduler.get_lane(request, tenant)):
+        result = await generate_image(token, formatted_prompt, model)
     
     return JSONResponse(content=format_response(result, n, size, prompt))
 
 
-def parse_request_body(body):
+def parse_request_body(body: request_models.ImageGenerationRequest):
     """
     解析请求体，提取参数
     """
-    try:
-        prompt = body.get('prompt', '')
-        n = body.get('n', 1)  # OpenAI支持生成多张图片，但Poe目前一次只能生成一张
-        size = body.get('size', '1024x1024')  # OpenAI格式的尺寸
-        model = body.get('model', 'dall-e-3')  # 默认使用DALL-E-3
-        response_format = body.get('response_format', 'url')  # url或b64_json
-            
-        return prompt, n, size, model, response_format
-    except Exception as e:
-        logger.error(f"解析请求体错误: {e}")
-        return None, 1, '1024x1024', "dall-e-3", "url"
+    return body.prompt, body.n, body.size, body.model, body.response_format
 
 
 def format_prompt_with_size(prompt, size):
@@ -73,25 +64,6 @@ def format_prompt_with_size(prompt, size):
         return prompt
 
 
-async def get_token_from_request(request_data):
-    """
-    从请求头中获取token
-    """
-    logger.info("请求头: %s", request_data.headers)
-    logger.info("开始获取token")
-    token = request_data.headers.get('Authorization', '').replace('Bearer ', '')
-
-    # 自定义token
-    custom_token = os.environ.get('CUSTOM_TOKEN')
-    # 内置token
-    system_token = os.environ.get('SYSTEM_TOKEN')
-
-    if token == custom_token:
-        return system_token
-
-    return token
-
-
 async def generate_image(token, prompt, model="dall-e-3"):
     """
     调用Poe API生成图片
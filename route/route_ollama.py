@@ -1,6 +1,5 @@
 import json
 import logging
-import os
 from datetime import datetime
 from typing import Dict, List, Any, Optional
 
@@ -9,7 +8,7 @@ from fastapi import APIRouter, Request
 from fastapi.responses import JSONResponse, StreamingResponse
 
 from api import poe_api
-from util import utils
+from util import utils, tenants, tracing, request_models, scheduler
 
 logger = logging.getLogger(__name__)
 
@@ -22,24 +21,28 @@ async def ollama_generate(request: Request):
     """
     Ollama generate endpoint - single prompt completion
     """
-    body = await request.json()
-    model, prompt, stream, format_type, options = parse_generate_request(body)
-    
-    if model is None or prompt is None:
-        return JSONResponse(content={"error": "Invalid request body"}, status_code=400)
+    with tracing.span("request.parse"):
+        body = await request_models.read_body(request, request_models.OllamaGenerateRequest)
+        model, prompt, stream, format_type, options = parse_generate_request(body)
 
-    token = await get_token_from_request(request)
+    token, tenant = await tenants.authorize(request, model, anonymous_fallback=True)
+    lane = scheduler.get_lane(request, tenant)
     
     # Convert single prompt to messages format for Poe
-    messages = [{"role": "user", "content": prompt}]
+    messages = [request_models.ChatMessage(role="user", content=prompt)]
     
     if stream:
+        stream_slot = await tenants.acquire_stream(tenant)
+        lease = await scheduler.acquire(lane, stream_slot)
         return StreamingResponse(
-            process_ollama_generate_stream(model, messages, token, format_type),
+            tenants.track_stream(
+                stream_slot, scheduler.track_stream(lease, process_ollama_generate_stream(model, messages, token, format_type))),
             media_type="application/x-ndjson"
         )
     else:
-        return await process_ollama_generate_response(model, messages, token, format_type)
+        async with scheduler.slot(lane):
+            return await process_ollama_generate_response(model, messages, token, format_type,
+                                                          tenants.cache_namespace(request, tenant))
 
 
 @router.post("/api/chat")
@@ -47,21 +50,28 @@ async def ollama_chat(request: Request):
     """
     Ollama chat endpoint - conversation with message history
     """
-    body = await request.json()
-    model, messages, stream, format_type, options = parse_chat_request(body)
+    with tracing.span("request.parse"):
+        body = await request_models.read_body(request, request_models.OllamaChatRequest)
+        model, messages, stream, format_type, options = parse_chat_request(body)
     
-    if model is None or not messages:
+    if not messages:
         return JSONResponse(content={"error": "Invalid request body"}, status_code=400)
 
-    token = await get_token_from_request(request)
+    token, tenant = await tenants.authorize(request, model, anonymous_fallback=True)
+    lane = scheduler.get_lane(request, tenant)
     
     if stream:
+        stream_slot = await tenants.acquire_stream(tenant)
+        lease = await scheduler.acquire(lane, stream_slot)
         return StreamingResponse(
-            process_ollama_chat_stream(model, messages, token, format_type),
+            tenants.track_stream(
+                stream_slot, scheduler.track_stream(lease, process_ollama_chat_stream(model, messages, token, format_type))),
             media_type="application/x-ndjson"
         )
     else:
-        return await process_ollama_chat_response(model, messages, token, format_type)
+        async with scheduler.slot(lane):
+            return await process_ollama_chat_response(model, messages, token, format_type,
+                                                      tenants.cache_namespace(request, tenant))
 
 
 @router.get("/api/tags")
@@ -73,59 +83,15 @@ async def ollama_tags():
     return JSONResponse(content={"models": models})
 
 
-def parse_generate_request(body: Dict[str, Any]):
+def parse_generate_request(body: request_models.OllamaGenerateRequest):
     """Parse Ollama generate request body"""
-    try:
-        model = body.get('model')
-        prompt = body.get('prompt')
-        stream = body.get('stream', True)  # Ollama defaults to streaming
-        format_type = body.get('format')
-        options = body.get('options', {})
-        
-        return model, prompt, stream, format_type, options
-    except Exception as e:
-        logger.error(f"Error parsing generate request: {e}")
-        return None, None, None, None, None
+    return body.model, body.prompt, body.stream, body.format, body.options
 
 
-def parse_chat_request(body: Dict[str, Any]):
+def parse_chat_request(body: request_models.OllamaChatRequest):
     """Parse Ollama chat request body"""
-    try:
-        model = body.get('model')
-        messages = body.get('messages', [])
-        stream = body.get('stream', True)  # Ollama defaults to streaming
-        format_type = body.get('format')
-        options = body.get('options', {})
-        
-        return model, messages, stream, format_type, options
-    except Exception as e:
-        logger.error(f"Error parsing chat request: {e}")
-        return None, None, None, None, None
-
-
-async def get_token_from_request(request: Request):
-    """Get token from request headers (same as other routes)"""
-    logger.info("Getting token for Ollama request")
-    auth_header = request.headers.get('Authorization', '')
-    
-    if auth_header.startswith('Bearer '):
-        token = auth_header.replace('Bearer ', '')
-    else:
-        token = auth_header
-
-    # Custom token
-    custom_token = os.environ.get('CUSTOM_TOKEN')
-    # Built-in token
-    system_token = os.environ.get('SYSTEM_TOKEN')
-
-    if token == custom_token:
-        return system_token
-    
-    # If no token provided, use system token as fallback
-    if not token:
-        return system_token
-
-    return token
+    request_models.check_message_count(body.messages)
+    return body.model, body.messages, body.stream, body.format, body.options
 
 
 def get_available_models() -> List[Dict[str, Any]]:
@@ -204,7 +170,7 @@ def get_poe_model_mapping(model: str) -> str:
     return fallback_mapping.get(model, "GPT-4o")  # Default to GPT-4o
 
 
-async def process_ollama_generate_stream(model: str, messages: List[Dict], token: str, format_type: Optional[str]):
+async def process_ollama_generate_stream(model: str, messages: List[request_models.ChatMessage], token: str, format_type: Optional[str]):
     """Process streaming generate response"""
     poe_model = get_poe_model_mapping(model)
     
@@ -217,16 +183,17 @@ async def process_ollama_generate_stream(model: str, messages: List[Dict], token
     yield f"{json.dumps(final_response)}\n"
 
 
-async def process_ollama_generate_response(model: str, messages: List[Dict], token: str, format_type: Optional[str]):
+async def process_ollama_generate_response(model: str, messages: List[request_models.ChatMessage], token: str, format_type: Optional[str],
+                                           cache_namespace: Optional[str] = None):
     """Process non-streaming generate response"""
     poe_model = get_poe_model_mapping(model)
-    result = await poe_api.get_responses(token, messages, poe_model)
+    result = await poe_api.get_responses(token, messages, poe_model, cache_namespace)
     
     response_data = format_ollama_final_response(model, result)
     return JSONResponse(content=response_data)
 
 
-async def process_ollama_chat_stream(model: str, messages: List[Dict], token: str, format_type: Optional[str]):
+async def process_ollama_chat_stream(model: str, messages: List[request_models.ChatMessage], token: str, format_type: Optional[str]):
     """Process streaming chat response"""
     poe_model = get_poe_model_mapping(model)
     
@@ -239,10 +206,11 @@ async def process_ollama_chat_stream(model: str, messages: List[Dict], token: st
     yield f"{json.dumps(final_response)}\n"
 
 
-async def process_ollama_chat_response(model: str, messages: List[Dict], token: str, format_type: Optional[str]):
+async def process_ollama_chat_response(model: str, messages: List[request_models.ChatMessage], token: str, format_type: Optional[str],
+                                       cache_namespace: Optional[str] = None):
     """Process non-streaming chat response"""
     poe_model = get_poe_model_mapping(model)
-    result = await poe_api.get_responses(token, messages, poe_model)
+    result = await poe_api.get_responses(token, messages, poe_model, cache_namespace)
     
     response_data = format_ollama_final_response(model, result)
     return JSONResponse(content=response_data)
@@ -0,0 +1,155 @@
+import asyncio
+import json
+import logging
+import os
+from contextlib import aclosing
+
+from dotenv import load_dotenv
+from fastapi import APIRouter, WebSocket
+from pydantic import ValidationError
+
+from api import poe_api
+from util import tenants, request_models, scheduler
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+load_dotenv()
+
+
+def get_max_concurrent():
+    return int(os.environ.get("WS_MAX_CONCURRENT", "16"))
+
+
+def get_send_queue_size():
+    return int(os.environ.get("WS_SEND_QUEUE", "256"))
+
+
+class FrameChannel:
+    """
+    连接上唯一的发送通道：数据帧需先拿到发送额度，客户端读得慢时生产者阻塞，上游读取随之暂停；
+    控制帧和拒绝类错误帧不占额度直接入队，接收循环不会因发送积压而无法处理取消
+    """
+
+    def __init__(self, size):
+        self.queue = asyncio.Queue()
+        self.credits = asyncio.Semaphore(size)
+
+    async def put_data(self, frame):
+        await self.credits.acquire()
+        self.queue.put_nowait((frame, True))
+
+    def put_control(self, frame):
+        self.queue.put_nowait((frame, False))
+
+    async def send_frames(self, websocket: WebSocket):
+        while True:
+            frame, is_data = await self.queue.get()
+            await websocket.send_text(json.dumps(frame, ensure_ascii=False, separators=(",", ":")))
+            if is_data:
+                self.credits.release()
+
+
+@router.websocket("/v1/ws")
+async def chat_websocket(websocket: WebSocket):
+    """
+    多路复用的补全接口：一个连接上并发多个请求，按客户端 id 交错返回增量
+    """
+    await websocket.accept()
+
+    channel = FrameChannel(get_send_queue_size())
+    tasks = {}
+    sender = asyncio.create_task(channel.send_frames(websocket))
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+
+            text = message.get("text")
+            if text is None:
+                text = (message.get("bytes") or b"").decode("utf-8", errors="replace")
+            await handle_frame(websocket, text, tasks, channel)
+    finally:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        sender.cancel()
+        await asyncio.gather(sender, return_exceptions=True)
+
+
+async def handle_frame(websocket: WebSocket, text: str, tasks: dict, channel: FrameChannel):
+    max_size = request_models.get_max_body_size()
+    if len(text) > max_size:
+        channel.put_control(error_frame(None, 413, f"Frame exceeds {max_size} bytes"))
+        return
+
+    try:
+        frame = request_models.WebSocketFrame.model_validate_json(text)
+    except ValidationError as e:
+        error = e.errors()[0]
+        location = ".".join(str(item) for item in error["loc"])
+        channel.put_control(error_frame(None, 400, f"Invalid frame: {location} {error['msg']}".replace("  ", " ")))
+        return
+
+    if frame.type == "cancel":
+        task = tasks.pop(frame.id, None)
+        if task is not None:
+            task.cancel()
+            channel.put_control({"id": frame.id, "cancelled": True})
+        return
+
+    if frame.id in tasks:
+        channel.put_control(error_frame(frame.id, 409, "Duplicate request id"))
+        return
+
+    if len(tasks) >= get_max_concurrent():
+        channel.put_control(error_frame(frame.id, 429, "Too many concurrent requests on this connection"))
+        return
+
+    try:
+        request_models.check_message_count(frame.messages)
+        # 并发流名额在 run_completion 中占用，任务启动前被取消时不会泄漏
+        token, tenant = await tenants.authorize(websocket, frame.model)
+    except (request_models.RequestError, tenants.TenantError) as e:
+        channel.put_control(error_frame(frame.id, e.status_code, e.message))
+        return
+
+    lane = scheduler.get_lane(websocket, tenant)
+    task = asyncio.create_task(
+        run_completion(frame.id, frame.model, frame.messages, token, tenant, lane, channel))
+    tasks[frame.id] = task
+    task.add_done_callback(lambda done: tasks.pop(frame.id, None) if tasks.get(frame.id) is done else None)
+
+
+async def run_completion(request_id, model, messages, token, tenant, lane, channel):
+    try:
+        stream_slot = await tenants.acquire_stream(tenant)
+    except tenants.TenantError as e:
+        channel.put_control(error_frame(request_id, e.status_code, e.message))
+        return
+
+    try:
+        lease = await scheduler.acquire(lane, stream_slot)
+    except scheduler.SchedulerError as e:
+        channel.put_control(error_frame(request_id, e.status_code, e.message))
+        return
+
+    stream = tenants.track_stream(
+        stream_slot, scheduler.track_stream(lease, poe_api.stream_get_responses(token, messages, model)))
+    try:
+        # aclosing 保证取消时上游流和名额立即释放
+        async with aclosing(stream) as deltas:
+            async for delta in deltas:
+                await channel.put_data({"id": request_id, "d": delta})
+        await channel.put_data({"id": request_id, "done": True})
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"WebSocket 请求 {request_id} 失败: {e}")
+        await channel.put_data(error_frame(request_id, 502, str(e)))
+
+
+def error_frame(request_id, status, message):
+    return {"id": request_id, "error": message, "status": status}
@@ -1,3 +1,5 @@
+import os
+
 import uvicorn
 from main import app
 
@@ -5,4 +7,5 @@ uvicorn.run(app, host='0.0.0.0',
             port=39527,
             proxy_headers=True,
             forwarded_allow_ips='*',
+            timeout_graceful_shutdown=int(os.environ.get('DRAIN_TIMEOUT', os.environ.get('TIME_OUT', '600'))),
             )
@@ -5,10 +5,19 @@ fi
 # app run
 core_num=${CORE_NUM:-5}
 time_out=${TIME_OUT:-600}
+drain_timeout=${DRAIN_TIMEOUT:-$time_out}
+preload=${PRELOAD:-false}
 param_str=${PARAM_STR}
 
 echo "core_num:$core_num"
 echo "time_out:$time_out"
+echo "drain_timeout:$drain_timeout"
+echo "preload:$preload"
 echo "param_str:$param_str"
 
-gunicorn -w $core_num -t $time_out -k uvicorn.workers.UvicornWorker $param_str -b 0.0.0.0:39527 main:app
\ No newline at end of file
+if [ "$preload" = "true" ];then
+  param_str="--preload $param_str"
+fi
+
+# graceful-timeout 需比排空时间稍长，留出关闭上游连接的时间
+gunicorn -w $core_num -t $time_out --graceful-timeout $((drain_timeout + 10)) -k uvicorn.workers.UvicornWorker $param_str -b 0.0.0.0:39527 main:app
@@ -0,0 +1,115 @@
+import logging
+import os
+from typing import Any, Dict, List, Literal, Optional, Union
+
+from pydantic import BaseModel, ConfigDict, ValidationError
+
+logger = logging.getLogger(__name__)
+
+
+class RequestError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+class ContentPart(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    type: str
+    text: Optional[str] = None
+
+
+class ChatMessage(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    role: str
+    content: Union[str, List[Union[ContentPart, str]], None] = None
+
+
+class ChatCompletionRequest(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    model: str = "gpt-3.5-turbo"
+    messages: List[ChatMessage] = []
+    stream: bool = False
+
+
+class ImageGenerationRequest(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    prompt: str
+    n: int = 1  # OpenAI支持生成多张图片，但Poe目前一次只能生成一张
+    size: str = "1024x1024"
+    model: str = "dall-e-3"
+    response_format: str = "url"  # url或b64_json
+
+
+class OllamaGenerateRequest(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    model: str
+    prompt: str
+    stream: bool = True  # Ollama defaults to streaming
+    format: Optional[Any] = None
+    options: Dict[str, Any] = {}
+
+
+class OllamaChatRequest(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    model: str
+    messages: List[ChatMessage] = []
+    stream: bool = True  # Ollama defaults to streaming
+    format: Optional[Any] = None
+    options: Dict[str, Any] = {}
+
+
+class WebSocketFrame(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    type: Literal["request", "cancel"] = "request"
+    id: str
+    model: str = "gpt-3.5-turbo"
+    messages: List[ChatMessage] = []
+
+
+def get_max_body_size():
+    return int(os.environ.get("MAX_BODY_SIZE", str(20 * 1024 * 1024)))
+
+
+def get_max_messages():
+    return int(os.environ.get("MAX_MESSAGES", "1000"))
+
+
+async def read_body(request, model_cls):
+    """
+    边读边计数，超过 MAX_BODY_SIZE 立即返回 413，读完后用 pydantic 的 JSON 解析器直接校验成请求模型
+    """
+    max_size = get_max_body_size()
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > max_size:
+        raise RequestError(413, f"Request body exceeds {max_size} bytes")
+
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_size:
+            raise RequestError(413, f"Request body exceeds {max_size} bytes")
+        chunks.append(chunk)
+
+    try:
+        return model_cls.model_validate_json(b"".join(chunks))
+    except ValidationError as e:
+        error = e.errors()[0]
+        location = ".".join(str(item) for item in error["loc"])
+        logger.debug(f"请求体解析错误: {e}")
+        raise RequestError(400, f"Invalid request body: {location} {error['msg']}".replace("  ", " "))
+
+
+def check_message_count(messages):
+    max_messages = get_max_messages()
+    if len(messages) > max_messages:
+        raise RequestError(413, f"Too many messages: {len(messages)} > {max_messages}")
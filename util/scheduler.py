@@ -0,0 +1,265 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from contextlib import aclosing, asynccontextmanager
+
+
+logger = logging.getLogger(__name__)
+
+LANE_HEADER = "x-priority-lane"
+
+DEFAULT_LANES = {
+    "editor": {"weight": 8, "min": 1},
+    "interactive": {"weight": 4, "min": 1},
+    "batch": {"weight": 1, "max": 8, "max_queue": 100, "max_wait": 60},
+}
+
+DEFAULT_ROUTE_LANES = {
+    "/api/generate": "editor",
+    "/api/chat": "editor",
+    "/v1/images/generations": "batch",
+}
+
+
+class SchedulerError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+class Lane:
+    def __init__(self, name, config, capacity):
+        self.name = name
+        self.weight = float(config.get("weight", 1))
+        self.floor = int(config.get("min", 0))
+        self.ceiling = int(config.get("max", capacity))
+        self.max_queue = int(config.get("max_queue", 0))
+        self.max_wait = float(config.get("max_wait", 0))
+
+        self.running = 0
+        self.waiters = deque()
+        self.virtual_time = 0.0
+
+        self.dispatched = 0
+        self.shed = 0
+        self.wait_samples = deque(maxlen=1024)
+
+    def get_stats(self):
+        samples = sorted(self.wait_samples)
+
+        def percentile(p):
+            if not samples:
+                return 0.0
+            return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000
+
+        return {
+            "weight": self.weight,
+            "min": self.floor,
+            "max": self.ceiling,
+            "running": self.running,
+            "queued": len(self.waiters),
+            "dispatched": self.dispatched,
+            "shed": self.shed,
+            "wait_ms": {
+                "p50": percentile(0.5),
+                "p99": percentile(0.99),
+                "max": samples[-1] * 1000 if samples else 0.0,
+            },
+        }
+
+
+class Lease:
+    def __init__(self, scheduler, lane):
+        self.scheduler = scheduler
+        self.lane = lane
+        self.released = False
+
+    def release(self):
+        if not self.released and self.lane is not None:
+            self.released = True
+            self.scheduler.release(self.lane)
+
+
+class Scheduler:
+    """
+    加权公平排队：每个 lane 有权重、并发下限和上限，空出的名额优先给低于下限的 lane，
+    其余按虚拟时间最小的 lane 分配；低优先级 lane 通过队列长度和最长等待时间丢弃请求
+    """
+
+    def __init__(self, capacity, lanes):
+        self.capacity = capacity
+        self.lanes = {name: Lane(name, config, capacity) for name, config in lanes.items()}
+        self.running = 0
+        self.virtual_clock = 0.0
+
+        # 进行中的调用不会被抢占，上限须给其他 lane 的下限留出名额，下限才是真正的预留
+        floors = sum(lane.floor for lane in self.lanes.values())
+        for lane in self.lanes.values():
+            lane.ceiling = max(1, min(lane.ceiling, capacity - (floors - lane.floor)))
+
+    def can_run(self, lane):
+        if lane.running >= lane.ceiling or self.running >= self.capacity:
+            return False
+        if lane.running < lane.floor:
+            return True
+        # 上限之外，再为有排队请求的其他 lane 预留未用满的下限
+        reserved = sum(max(0, other.floor - other.running)
+                       for other in self.lanes.values() if other is not lane and other.waiters)
+        return self.running + reserved < self.capacity
+
+    def start(self, lane, waited):
+        lane.running += 1
+        self.running += 1
+        lane.dispatched += 1
+        lane.wait_samples.append(waited)
+
+        start = max(lane.virtual_time, self.virtual_clock)
+        lane.virtual_time = start + 1 / lane.weight
+        self.virtual_clock = start
+
+    def dispatch(self):
+        while self.running < self.capacity:
+            candidates = []
+            for lane in self.lanes.values():
+                while lane.waiters and lane.waiters[0][0].done():
+                    lane.waiters.popleft()
+                if lane.waiters and self.can_run(lane):
+                    candidates.append(lane)
+            if not candidates:
+                return
+
+            lane = min(candidates, key=lambda item: (item.running >= item.floor, item.virtual_time))
+            future, enqueued_at = lane.waiters.popleft()
+            self.start(lane, time.monotonic() - enqueued_at)
+            future.set_result(None)
+
+    def release(self, lane):
+        lane.running -= 1
+        self.running -= 1
+        self.dispatch()
+
+    async def acquire(self, lane_name):
+        lane = self.lanes[lane_name]
+        if not lane.waiters and self.can_run(lane):
+            self.start(lane, 0.0)
+            return Lease(self, lane)
+
+        if lane.max_queue and len(lane.waiters) >= lane.max_queue:
+            lane.shed += 1
+            raise SchedulerError(503, f"Lane {lane_name} is overloaded, please retry later")
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (future, time.monotonic())
+        lane.waiters.append(entry)
+        try:
+            await asyncio.wait_for(future, lane.max_wait or None)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # 超时或取消的同时已被分配名额，归还
+                self.release(lane)
+            elif entry in lane.waiters:
+                lane.waiters.remove(entry)
+            if isinstance(e, asyncio.TimeoutError):
+                lane.shed += 1
+                raise SchedulerError(503, f"Lane {lane_name} queue wait exceeded {lane.max_wait:.0f}s")
+            raise
+        return Lease(self, lane)
+
+    def get_stats(self):
+        return {
+            "enabled": True,
+            "capacity": self.capacity,
+            "running": self.running,
+            "lanes": {name: lane.get_stats() for name, lane in self.lanes.items()},
+        }
+
+
+scheduler = None
+route_lanes = {}
+default_lane = None
+_initialized = False
+
+
+def get_scheduler():
+    """
+    SCHEDULER_CAPACITY 为每个 worker 的上游并发数，未配置时不启用调度
+    """
+    global scheduler, route_lanes, default_lane, _initialized
+    if not _initialized:
+        capacity = int(os.environ.get("SCHEDULER_CAPACITY", "0"))
+        if capacity > 0:
+            lanes = json.loads(os.environ.get("SCHEDULER_LANES", "null")) or DEFAULT_LANES
+            scheduler = Scheduler(capacity, lanes)
+            route_lanes = json.loads(os.environ.get("SCHEDULER_ROUTE_LANES", "null")) or DEFAULT_ROUTE_LANES
+            default_lane = os.environ.get("SCHEDULER_DEFAULT_LANE", "interactive")
+        _initialized = True
+    return scheduler
+
+
+def get_lane(request, tenant=None):
+    """
+    lane 选择顺序：租户配置 > 路由默认；X-Priority-Lane 请求头只能降级到权重不高于路由默认的 lane，
+    租户配置 allow_lane_header 时才允许提升
+    """
+    current = get_scheduler()
+    if current is None:
+        return None
+
+    if tenant is not None and tenant.lane in current.lanes:
+        return tenant.lane
+
+    lane = route_lanes.get(request.url.path, default_lane)
+    if lane not in current.lanes:
+        lane = next(iter(current.lanes))
+
+    requested = request.headers.get(LANE_HEADER)
+    if requested in current.lanes:
+        allow_promote = tenant is not None and tenant.allow_lane_header
+        if allow_promote or current.lanes[requested].weight <= current.lanes[lane].weight:
+            return requested
+    return lane
+
+
+async def acquire(lane, stream_slot=None):
+    """
+    排队获取上游名额；被丢弃或取消时一并释放租户的并发流名额
+    """
+    current = get_scheduler()
+    if current is None or lane is None:
+        return Lease(current, None)
+
+    try:
+        return await current.acquire(lane)
+    except (SchedulerError, asyncio.CancelledError):
+        if stream_slot is not None:
+            await stream_slot.release()
+        raise
+
+
+@asynccontextmanager
+async def slot(lane):
+    lease = await acquire(lane)
+    try:
+        yield lease
+    finally:
+        lease.release()
+
+
+async def track_stream(lease, generator):
+    try:
+        async with aclosing(generator) as items:
+            async for item in items:
+                yield item
+    finally:
+        lease.release()
+
+
+def get_stats():
+    current = get_scheduler()
+    if current is None:
+        return {"enabled": False}
+    return current.get_stats()
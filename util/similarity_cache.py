@@ -0,0 +1,220 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_BITS = 64
+
+# 每个字节的 1 的个数，用于向量化计算汉明距离（numpy 1.26 没有 bitwise_count）
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_WORD_RE = re.compile(r"\w+|[^\w\s]")
+
+# 只归一化时间戳和 ID 形式的数字，其余数字保留为特征，避免 "17 * 23" 与 "98 * 41" 被当成同一个请求
+_VOLATILE_PATTERNS = [
+    (re.compile(r"\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b"), " idval "),
+    (re.compile(r"\b\d{4}-\d{2}-\d{2}(?:[t ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:z|[+-]\d{2}:?\d{2})?)?\b"), " tsval "),
+    (re.compile(r"\b\d{1,2}:\d{2}(?::\d{2}(?:\.\d+)?)?\b"), " tsval "),
+    (re.compile(r"\b\d{10,13}\b"), " tsval "),
+]
+
+
+def normalize_text(text):
+    """
+    归一化文本：小写、UUID / ISO 时间 / 时刻 / Unix 时间戳替换为占位符、合并空白
+    """
+    text = text.lower()
+    for pattern, placeholder in _VOLATILE_PATTERNS:
+        text = pattern.sub(placeholder, text)
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def poe_messages_to_text(messages):
+    """
+    将 openai_message_to_poe_message 生成的 ProtocolMessage 列表拼成一段用于指纹的文本
+    """
+    return "\n".join(f"{message.role}: {normalize_text(message.content)}" for message in messages)
+
+
+def fingerprint(messages):
+    """
+    拆分出最后一条用户消息（归一化后需精确匹配）和其余上下文（用 SimHash 近似匹配），
+    避免较长的共享 system prompt 掩盖真正变化的问题
+    """
+    last_user = max((i for i, message in enumerate(messages) if message.role == "user"), default=None)
+    query = normalize_text(messages[last_user].content) if last_user is not None else ""
+    context = [message for i, message in enumerate(messages) if i != last_user]
+    return query, simhash(poe_messages_to_text(context))
+
+
+def _hash64(value):
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def simhash(text):
+    """
+    计算 64 位 SimHash，特征为单词和相邻词对
+    """
+    words = _WORD_RE.findall(text)
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    if not features:
+        return np.uint64(0)
+
+    hashes = np.array([_hash64(feature) for feature in features], dtype="<u8")
+    bits = np.unpackbits(hashes.view(np.uint8), bitorder="little").reshape(-1, SIGNATURE_BITS)
+    votes = bits.sum(axis=0, dtype=np.int64) * 2 > len(features)
+    return np.packbits(votes, bitorder="little").view("<u8")[0]
+
+
+class SimilarityCache:
+    """
+    近似重复请求缓存：签名存放在定长 numpy 数组里，查询时一次向量化计算全部汉明距离，
+    写满后按 FIFO 覆盖最旧的条目
+    """
+
+    def __init__(self, capacity=4096, max_distance=3, model_thresholds=None, ttl=3600):
+        self.capacity = capacity
+        self.max_distance = max_distance
+        self.model_thresholds = model_thresholds or {}
+        self.ttl = ttl
+
+        self.signatures = np.zeros(capacity, dtype="<u8")
+        self.namespaces = np.zeros(capacity, dtype="<u8")
+        self.expires_at = np.zeros(capacity, dtype=np.float64)
+        self.responses = [None] * capacity
+        self.next_slot = 0
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        # 每次查询的最近距离分布，下标为汉明距离，最后一位表示没有同命名空间的候选
+        self.distance_histogram = np.zeros(SIGNATURE_BITS + 2, dtype=np.int64)
+
+    def get_threshold(self, model):
+        return self.model_thresholds.get(model, self.max_distance)
+
+    def lookup(self, namespace, model, signature):
+        threshold = self.get_threshold(model)
+        if self.size == 0 or threshold < 0:
+            self.misses += 1
+            self.distance_histogram[-1] += 1
+            return None
+
+        signatures = self.signatures[:self.size]
+        candidates = (self.namespaces[:self.size] == namespace) & (self.expires_at[:self.size] > time.time())
+        if not candidates.any():
+            self.misses += 1
+            self.distance_histogram[-1] += 1
+            return None
+
+        xor = np.bitwise_xor(signatures, signature)
+        distances = _POPCOUNT_TABLE[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.int64)
+        distances[~candidates] = SIGNATURE_BITS + 1
+
+        best = int(np.argmin(distances))
+        distance = int(distances[best])
+        self.distance_histogram[distance] += 1
+
+        if distance > threshold:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        logger.debug("相似缓存命中: model=%s distance=%d", model, distance)
+        return self.responses[best]
+
+    def store(self, namespace, signature, response):
+        slot = self.next_slot
+        self.signatures[slot] = signature
+        self.namespaces[slot] = namespace
+        self.expires_at[slot] = time.time() + self.ttl
+        self.responses[slot] = response
+
+        self.next_slot = (slot + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def get_stats(self):
+        total = self.hits + self.misses
+        return {
+            "enabled": True,
+            "size": self.size,
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "max_distance": self.max_distance,
+            "model_thresholds": self.model_thresholds,
+            "distance_histogram": {
+                str(distance): int(count)
+                for distance, count in enumerate(self.distance_histogram[:SIGNATURE_BITS + 1]) if count
+            },
+            "no_candidate": int(self.distance_histogram[-1]),
+        }
+
+
+def create_cache():
+    if os.environ.get("SIMILARITY_CACHE", "false").lower() not in ("1", "true", "yes"):
+        return None
+
+    return SimilarityCache(
+        capacity=int(os.environ.get("SIMILARITY_CACHE_SIZE", "4096")),
+        max_distance=int(os.environ.get("SIMILARITY_CACHE_MAX_DISTANCE", "3")),
+        model_thresholds=json.loads(os.environ.get("SIMILARITY_CACHE_THRESHOLDS", "{}")),
+        ttl=float(os.environ.get("SIMILARITY_CACHE_TTL", "3600")),
+    )
+
+
+cache = None
+_initialized = False
+
+
+def get_cache():
+    """
+    延迟创建，保证 load_dotenv 之后再读取环境变量
+    """
+    global cache, _initialized
+    if not _initialized:
+        cache = create_cache()
+        _initialized = True
+    return cache
+
+
+def namespace_key(namespace, bot, query):
+    """
+    不同租户（或代理 key）、不同模型、不同问题的缓存互相隔离，只有上下文参与近似匹配
+    """
+    return np.uint64(_hash64(f"{namespace}\x00{bot}\x00{query}"))
+
+
+def lookup(namespace, bot, messages):
+    """
+    返回 (缓存的响应, 写回缓存用的键)，未启用缓存时都为 None
+    """
+    similarity_cache = get_cache()
+    if similarity_cache is None:
+        return None, None
+
+    query, signature = fingerprint(messages)
+    key = (namespace_key(namespace, bot, query), signature)
+    return similarity_cache.lookup(key[0], bot, signature), key
+
+
+def store(key, response):
+    similarity_cache = get_cache()
+    if similarity_cache is None or key is None:
+        return
+    similarity_cache.store(*key, response)
+
+
+def get_stats():
+    similarity_cache = get_cache()
+    if similarity_cache is None:
+        return {"enabled": False}
+    return similarity_cache.get_stats()
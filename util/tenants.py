@@ -0,0 +1,257 @@
+import itertools
+import json
+import logging
+import os
+import time
+from contextlib import aclosing
+
+from util import utils
+
+logger = logging.getLogger(__name__)
+
+# 令牌桶：返回 1 表示放行，0 表示超限
+_TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1]) or burst
+local ts = tonumber(data[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return allowed
+"""
+
+# 并发流记录在 ZSET 中，score 为截止时间；先清理过期条目，worker 崩溃遗留的名额到期后自动回收
+_ACQUIRE_STREAM_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[4])
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[5]))
+return 1
+"""
+
+
+class TenantError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+class Tenant:
+    def __init__(self, name, config):
+        self.name = name
+        self.models = set(config.get("models") or [])
+        self.rate = float(config.get("rate", 0))
+        self.burst = float(config.get("burst", max(self.rate, 1)))
+        self.max_streams = int(config.get("max_streams", 0))
+        self.lane = config.get("lane")
+        self.allow_lane_header = bool(config.get("allow_lane_header", False))
+
+        upstream_keys = config.get("upstream_keys") or [os.environ.get("SYSTEM_TOKEN")]
+        self._upstream_keys = itertools.cycle(upstream_keys)
+
+    def next_upstream_key(self):
+        return next(self._upstream_keys)
+
+    def allows_model(self, model):
+        return not self.models or "*" in self.models or model in self.models
+
+
+class MemoryLimiter:
+    """
+    单进程计数，多个 gunicorn worker 之间不共享，需要跨 worker 时请配置 REDIS_URL
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.streams = {}
+
+    async def take_token(self, tenant):
+        now = time.monotonic()
+        tokens, ts = self.buckets.get(tenant.name, (tenant.burst, now))
+        tokens = min(tenant.burst, tokens + (now - ts) * tenant.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[tenant.name] = (tokens, now)
+        return allowed
+
+    async def acquire_stream(self, tenant, stream_id):
+        streams = self.streams.setdefault(tenant.name, set())
+        if len(streams) >= tenant.max_streams:
+            return False
+        streams.add(stream_id)
+        return True
+
+    async def release_stream(self, tenant, stream_id):
+        self.streams.get(tenant.name, set()).discard(stream_id)
+
+
+class RedisLimiter:
+    def __init__(self, redis_url, prefix="poe2openai"):
+        from redis import asyncio as aioredis
+
+        self.redis = aioredis.from_url(redis_url)
+        self.prefix = prefix
+        self.stream_ttl = int(os.environ.get("TIME_OUT", "600")) + 60
+        self.token_bucket = self.redis.register_script(_TOKEN_BUCKET_SCRIPT)
+        self.acquire_stream_script = self.redis.register_script(_ACQUIRE_STREAM_SCRIPT)
+
+    async def take_token(self, tenant):
+        key = f"{self.prefix}:bucket:{tenant.name}"
+        return bool(await self.token_bucket(keys=[key], args=[tenant.rate, tenant.burst, time.time()]))
+
+    async def acquire_stream(self, tenant, stream_id):
+        key = f"{self.prefix}:streams:{tenant.name}"
+        now = time.time()
+        return bool(await self.acquire_stream_script(
+            keys=[key], args=[tenant.max_streams, now, now + self.stream_ttl, stream_id, self.stream_ttl]))
+
+    async def release_stream(self, tenant, stream_id):
+        await self.redis.zrem(f"{self.prefix}:streams:{tenant.name}", stream_id)
+
+
+async def load_tenant_config():
+    """
+    租户表来源：TENANTS_FILE 指定的 JSON 文件，或 REDIS_URL 中 TENANTS_REDIS_KEY 对应的 JSON 字符串
+    """
+    tenants_file = os.environ.get("TENANTS_FILE")
+    if tenants_file:
+        with open(tenants_file, encoding="utf-8") as f:
+            return json.load(f)
+
+    redis_key = os.environ.get("TENANTS_REDIS_KEY")
+    redis_url = os.environ.get("REDIS_URL")
+    if redis_key and redis_url:
+        from redis import asyncio as aioredis
+
+        client = aioredis.from_url(redis_url)
+        try:
+            value = await client.get(redis_key)
+        finally:
+            await client.close()
+        return json.loads(value) if value else {}
+
+    return {}
+
+
+def build_key_index(config):
+    """
+    代理 key -> 租户，请求时 O(1) 查找
+    """
+    key_index = {}
+    for name, tenant_config in config.items():
+        tenant = Tenant(name, tenant_config)
+        for key in tenant_config.get("keys", []):
+            key_index[key] = tenant
+    return key_index
+
+
+key_index = None
+limiter = None
+
+
+async def init():
+    """
+    启动时在 lifespan 中调用；未经 lifespan 启动时在首个请求中加载
+    """
+    global key_index, limiter
+    key_index = build_key_index(await load_tenant_config())
+    redis_url = os.environ.get("REDIS_URL")
+    limiter = RedisLimiter(redis_url) if redis_url else MemoryLimiter()
+    logger.info("已加载 %d 个租户 key", len(key_index))
+
+
+def get_request_key(request):
+    auth_header = request.headers.get('Authorization', '')
+    if auth_header.startswith('Bearer '):
+        return auth_header[len('Bearer '):]
+    return auth_header
+
+
+def cache_namespace(request, tenant):
+    """
+    缓存按租户隔离；未匹配租户时按调用方的代理 key 隔离，而不是按上游 Poe key
+    """
+    if tenant is not None:
+        return f"tenant:{tenant.name}"
+    return f"key:{get_request_key(request)}"
+
+
+async def authorize(request, model, anonymous_fallback=False):
+    """
+    根据请求头中的 key 返回 (上游 Poe key, 租户)，在请求上游之前完成模型和限流检查，并发流名额由 acquire_stream 单独占用。
+    未匹配租户表时保持原有行为：CUSTOM_TOKEN 换成 SYSTEM_TOKEN，其余 key 直接透传
+    """
+    if key_index is None:
+        await init()
+
+    token = get_request_key(request)
+    tenant = key_index.get(token)
+
+    if tenant is None:
+        system_token = os.environ.get('SYSTEM_TOKEN')
+        if token == os.environ.get('CUSTOM_TOKEN'):
+            return system_token, None
+        if not token and anonymous_fallback:
+            return system_token, None
+        return token, None
+
+    if not tenant.allows_model(model):
+        raise TenantError(403, f"Model {model} is not allowed for this key")
+
+    if tenant.rate > 0 and not await limiter.take_token(tenant):
+        raise TenantError(429, "Rate limit exceeded")
+
+    return tenant.next_upstream_key(), tenant
+
+
+class StreamSlot:
+    """
+    一个并发流名额，按 id 记录，重复释放无副作用
+    """
+
+    def __init__(self, tenant, stream_id=None):
+        self.tenant = tenant
+        self.stream_id = stream_id
+        self.released = False
+
+    async def release(self):
+        if not self.released and self.stream_id is not None:
+            self.released = True
+            await limiter.release_stream(self.tenant, self.stream_id)
+
+
+async def acquire_stream(tenant):
+    """
+    占用一个并发流名额，调用方负责在流结束时释放；租户不限并发流时返回空名额
+    """
+    if tenant is None or tenant.max_streams <= 0:
+        return StreamSlot(tenant)
+
+    stream_id = utils.get_uuid()
+    if not await limiter.acquire_stream(tenant, stream_id):
+        raise TenantError(429, "Too many concurrent streams")
+    return StreamSlot(tenant, stream_id)
+
+
+async def track_stream(stream_slot, generator):
+    """
+    包装流式生成器，结束或客户端断开时释放并发流名额
+    """
+    try:
+        async with aclosing(generator) as items:
+            async for item in items:
+                yield item
+    finally:
+        await stream_slot.release()
@@ -0,0 +1,245 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import random
+import re
+import secrets
+import time
+from contextlib import contextmanager
+
+import httpx
+
+from util import utils
+
+logger = logging.getLogger(__name__)
+
+_TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+# httpcore trace 事件 -> span 名称；连接复用时不会出现建连事件
+_CONNECTION_SPANS = {
+    "connect_tcp": "upstream.connect_tcp",
+    "start_tls": "upstream.tls",
+    "setup_socks5_connection": "upstream.proxy_handshake",
+    "receive_response_headers": "upstream.response_headers",
+}
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+# 保存后台上报任务的引用，避免被回收
+_export_tasks = set()
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id=None, **attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+
+    def end(self, **attributes):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": (self.end_ns - self.start_ns) / 1e6 if self.end_ns else None,
+            "attributes": self.attributes,
+        }
+
+
+class Trace:
+    def __init__(self, name, request_id, trace_id=None, parent_id=None, sampled=False):
+        self.request_id = request_id
+        self.trace_id = trace_id or secrets.token_hex(16)
+        self.sampled = sampled
+        self.root = Span(name, self.trace_id, parent_id, request_id=request_id)
+        self.spans = [self.root]
+
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.root.span_id}-{'01' if self.sampled else '00'}"
+
+
+def get_sample_rate():
+    return float(os.environ.get("TRACE_SAMPLE_RATE", "0"))
+
+
+def start_trace(headers, name):
+    """
+    根据请求头中的 traceparent / X-Request-ID 开始一次追踪，上游已采样时跟随上游，否则按 TRACE_SAMPLE_RATE 采样
+    """
+    request_id = headers.get("x-request-id") or utils.get_uuid()
+    match = _TRACEPARENT_RE.match(headers.get("traceparent", "").strip().lower())
+    if match:
+        trace_id, parent_id, flags = match.groups()
+        sampled = int(flags, 16) & 1 == 1
+    else:
+        trace_id, parent_id = None, None
+        sampled = random.random() < get_sample_rate()
+
+    trace = Trace(name, request_id, trace_id, parent_id, sampled)
+    _current_trace.set(trace)
+    _current_span.set(trace.root)
+    return trace
+
+
+def start_span(name, **attributes):
+    """
+    手动开始一个子 span，不改变当前 span，适合跨 yield 的流式阶段；未采样时返回 None
+    """
+    trace = _current_trace.get()
+    if trace is None or not trace.sampled:
+        return None
+
+    parent = _current_span.get()
+    new_span = Span(name, trace.trace_id, parent.span_id if parent else None, **attributes)
+    trace.spans.append(new_span)
+    return new_span
+
+
+def end_span(current, **attributes):
+    if current is not None:
+        current.end(**attributes)
+
+
+@contextmanager
+def span(name, **attributes):
+    current = start_span(name, **attributes)
+    if current is None:
+        yield None
+        return
+
+    token = _current_span.set(current)
+    try:
+        yield current
+    except Exception as e:
+        current.attributes["error"] = repr(e)
+        raise
+    finally:
+        current.end()
+        _current_span.reset(token)
+
+
+def outgoing_headers():
+    """
+    发往 Poe 的请求携带 traceparent
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return {}
+    current = _current_span.get() or trace.root
+    return {"traceparent": f"00-{trace.trace_id}-{current.span_id}-{'01' if trace.sampled else '00'}"}
+
+
+def connection_tracer():
+    """
+    返回 httpx 请求的 trace 扩展回调，把 TCP 连接、代理握手、TLS 握手和等待响应头记录为 span；未采样时返回 None
+    """
+    trace = _current_trace.get()
+    if trace is None or not trace.sampled:
+        return None
+
+    open_spans = {}
+
+    async def on_event(event_name, info):
+        name, _, stage = event_name.rpartition(".")
+        span_name = _CONNECTION_SPANS.get(name.rsplit(".", 1)[-1])
+        if span_name is None:
+            return
+        if stage == "started":
+            open_spans[name] = start_span(span_name, layer=name.split(".")[0])
+        elif stage == "failed":
+            end_span(open_spans.pop(name, None), error=repr(info.get("exception")))
+        else:
+            end_span(open_spans.pop(name, None))
+
+    return on_event
+
+
+async def trace_body(trace, body_iterator):
+    """
+    包装响应体，响应全部发送后结束追踪
+    """
+    flush = start_span("response.body")
+    chunks = 0
+    try:
+        async for chunk in body_iterator:
+            chunks += 1
+            yield chunk
+    finally:
+        end_span(flush, chunks=chunks)
+        finish_trace(trace)
+
+
+def finish_trace(trace, **attributes):
+    trace.root.end(**attributes)
+    if not trace.sampled:
+        return
+
+    trace_file = os.environ.get("TRACE_FILE")
+    if trace_file:
+        try:
+            with open(trace_file, "a", encoding="utf-8") as f:
+                for current in trace.spans:
+                    f.write(json.dumps(current.to_dict(), ensure_ascii=False) + "\n")
+        except OSError as e:
+            logger.warning("写入追踪文件失败: %s", e)
+
+    endpoint = os.environ.get("TRACE_OTLP_ENDPOINT")
+    if endpoint:
+        task = asyncio.get_running_loop().create_task(export_otlp(endpoint, trace))
+        _export_tasks.add(task)
+        task.add_done_callback(_export_tasks.discard)
+
+
+def to_otlp(trace):
+    def attribute(key, value):
+        if isinstance(value, bool):
+            return {"key": key, "value": {"boolValue": value}}
+        if isinstance(value, int):
+            return {"key": key, "value": {"intValue": str(value)}}
+        if isinstance(value, float):
+            return {"key": key, "value": {"doubleValue": value}}
+        return {"key": key, "value": {"stringValue": str(value)}}
+
+    spans = []
+    for current in trace.spans:
+        otlp_span = {
+            "traceId": current.trace_id,
+            "spanId": current.span_id,
+            "name": current.name,
+            "kind": 2 if current is trace.root else 1,
+            "startTimeUnixNano": str(current.start_ns),
+            "endTimeUnixNano": str(current.end_ns or current.start_ns),
+            "attributes": [attribute(key, value) for key, value in current.attributes.items()],
+        }
+        if current.parent_id:
+            otlp_span["parentSpanId"] = current.parent_id
+        spans.append(otlp_span)
+
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [attribute("service.name", os.environ.get("TRACE_SERVICE_NAME", "poe-2-openai"))]},
+            "scopeSpans": [{"scope": {"name": "poe-2-openai"}, "spans": spans}],
+        }]
+    }
+
+
+async def export_otlp(endpoint, trace):
+    try:
+        async with httpx.AsyncClient(timeout=5) as client:
+            await client.post(endpoint, json=to_otlp(trace))
+    except Exception as e:
+        logger.warning("上报追踪数据失败: %s", e)